@@ -117,7 +117,11 @@ def main():
 
     candidate_vectors = torch.from_numpy(data.training)
     indexes = hash_by_batch(hasher, candidate_vectors, 4096)
-    index2row = build_index(indexes)
+    keys, offsets, rows = build_index(indexes)
+    index2row = {
+        int(k): rows[start:end]
+        for k, start, end in zip(keys, offsets[:-1], offsets[1:])
+    }
     index2rownum = {
         k: v.shape[0]
         for k, v in index2row.items()
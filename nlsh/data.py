@@ -82,18 +82,31 @@ class Glove:
         return self._training_self_knn
 
     @staticmethod
-    def pairwise_distance(v1, v2):
+    def norm(v):
+        """L2 norm of each row, can be precomputed for `pairwise_distance`
+
+        v: (n, d)
+
+        Returns
+        N: (n)
+        """
+        return v.norm(dim=1)
+
+    @staticmethod
+    def pairwise_distance(v1, v2, v2_norm=None):
         """Cosine distance betwenn 2 matrix
 
         v1: (n, d)
         v2: (m, d)
+        v2_norm: (m), optional precomputed `norm(v2)`
 
         Returns
         D: (n, m) where D[i, j] is the distance between v1[i, :] and v2[j, :]
         """
+        if v2_norm is None:
+            v2_norm = v2.norm(dim=1)
         v1_normalized = v1 / v1.norm(dim=1)[:, None]
-        v2_normalized = v2 / v2.norm(dim=1)[:, None]
-        cosine_similarity = torch.mm(v1_normalized, v2_normalized.T)
+        cosine_similarity = torch.mm(v1_normalized, v2.T) / v2_norm[None, :]
         return 1 - cosine_similarity
 
     @staticmethod
@@ -174,19 +187,32 @@ class SIFT:
         return self._training_self_knn
 
     @staticmethod
-    def pairwise_distance(v1, v2):
+    def norm(v):
+        """Squared L2 norm of each row, can be precomputed for `pairwise_distance`
+
+        v: (n, d)
+
+        Returns
+        N: (n)
+        """
+        return v.pow(2).sum(dim=-1)
+
+    @staticmethod
+    def pairwise_distance(v1, v2, v2_norm=None):
         """Euclidean distance betwenn 2 matrix
 
         v1: (n, d)
         v2: (m, d)
+        v2_norm: (m), optional precomputed `norm(v2)`, i.e. squared L2 norms
 
         Returns
         D: (n, m) where D[i, j] is the distance between v1[i, :] and v2[j, :]
         """
-        p_norm = p.pow(2).sum(dim=-1, keepdim=True)
-        q_norm = q.pow(2).sum(dim=-1, keepdim=True)
-        result = torch.addmm(q_norm.transpose(-2, -1), p, q.transpose(-2, -1), alpha=-2).add_(p_norm)
-        return torch.sqrt(result)
+        if v2_norm is None:
+            v2_norm = v2.pow(2).sum(dim=-1)
+        v1_norm = v1.pow(2).sum(dim=-1, keepdim=True)
+        result = torch.addmm(v2_norm[None, :], v1, v2.T, alpha=-2).add_(v1_norm)
+        return torch.sqrt(result.clamp_(min=0))
 
     @staticmethod
     def distance(v1, v2):
@@ -5,8 +5,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from nlsh.utils import hash_codes
-
 
 class MultivariateBernoulli:
 
@@ -27,6 +25,10 @@ class MultivariateBernoulli:
             return x
 
     def __init__(self, encoder, hash_size, distance_func, tanh_output=False):
+        if hash_size > 63:
+            raise ValueError(
+                f"`hash_size` should be at most 63 to fit in int64 keys, but got {hash_size}"
+            )
         self._encoder = encoder
         self._hash_size = hash_size
 
@@ -69,27 +71,25 @@ class MultivariateBernoulli:
             probs = probs / 2. + 0.5
         dist = torch.distributions.Bernoulli(probs)
 
-        base_codes = (dist.probs > 0.5).unsqueeze_(1).int()
+        base_codes = (dist.probs > 0.5).unsqueeze_(1).long()
 
         if n == 1:
             # hard hash
-            codes = base_codes.cpu().numpy()
+            codes = base_codes
         elif n > 1:
             # sample hash
             # (batch_size, n, code_size)
-            sampled_codes = dist.sample((n - 1,)).int().permute(1, 0, 2).int()
-            codes = torch.cat((base_codes.int(), sampled_codes), dim=1).cpu().numpy()
+            sampled_codes = dist.sample((n - 1,)).long().permute(1, 0, 2)
+            codes = torch.cat((base_codes, sampled_codes), dim=1)
         else:
             raise ValueError(f"`n` should be positive integer, but got {n}")
 
-        hash_results = hash_codes(codes)
-        # hash_results = []
-        # for binarrs in codes:
-        #     hashes = []
-        #     for binarr in binarrs:
-        #         hashes.append(binarr_to_int(binarr))
-        #     hash_results.append(set(hashes))
-        return hash_results
+        # NOTE: pack the bits of each code into one int64 key on device, most
+        # significant bit first, so only (batch_size, n) keys are copied to
+        # host instead of (batch_size, n, code_size) bits
+        bit_shifts = torch.arange(self._hash_size - 1, -1, -1, device=codes.device)
+        hash_keys = (codes << bit_shifts).sum(dim=-1)
+        return [set(keys) for keys in hash_keys.tolist()]
 
 
 class Categorical:
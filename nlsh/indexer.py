@@ -1,96 +1,253 @@
-from typing import List
+from itertools import chain
+from typing import List, Tuple
 
+import numpy as np
 import torch
 
+# upper bound of the (n_queries, n_candidates) distance matrix materialized
+# at once in `Indexer.query`, larger buckets are streamed in chunks
+MAX_DISTANCE_ELEMENTS = 2 ** 26
+
+
+def _ranges(sizes):
+    """concatenated aranges, e.g. sizes [2, 3] gives [0, 1, 0, 1, 2]"""
+    return np.arange(sizes.sum(), dtype=np.int64) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+
+def _flatten(indexes):
+    """flatten a list of key sets
+
+    Returns
+    keys: (n_keys,) all keys of all sets
+    owners: (n_keys,) owners[i] is the position in `indexes` of the set keys[i] is from
+    slots: (n_keys,) slots[i] is the position of keys[i] inside its set
+    """
+    n_keys = np.fromiter(
+        (len(index_set) for index_set in indexes),
+        dtype=np.int64,
+        count=len(indexes),
+    )
+    keys = np.fromiter(chain.from_iterable(indexes), dtype=np.int64, count=n_keys.sum())
+    owners = np.repeat(np.arange(len(indexes), dtype=np.int64), n_keys)
+    slots = _ranges(n_keys)
+    return keys, owners, slots
+
+
+def _to_device(array, device):
+    tensor = torch.from_numpy(array)
+    if device.type == "cuda":
+        # NOTE: copies from pinned memory are asynchronous, so the upload
+        # overlaps with the kernels already queued on the device
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
+
 
 def build_index(indexes, cuda=True):
-    index2row = {}
-    for idx, index_set in enumerate(indexes):
-        for index in index_set:
-            if index not in index2row:
-                index2row[index] = [idx]
-            else:
-                index2row[index].append(idx)
+    """group rows by hash keys into a CSR layout
 
-    # NOTE: this is a import speed optimization
-    # allocating a new LongTensor is non trivial and will dominate
-    # the evaluation process time
-    for index, rows in index2row.items():
-        if cuda:
-            index2row[index] = torch.LongTensor(rows).cuda()
-        else:
-            index2row[index] = torch.LongTensor(rows)
+    indexes: list of key sets, indexes[i] are the buckets row i is hashed into
+
+    Returns
+    keys: (n_buckets,) sorted unique keys
+    offsets: (n_buckets + 1,) rows of bucket keys[i] are rows[offsets[i]:offsets[i + 1]]
+    rows: (n_keys,) torch long tensor of row ids
+    """
+    keys, rows, _ = _flatten(indexes)
+
+    # NOTE: group rows by key with a stable sort instead of growing python
+    # lists in a dict, rows of each bucket stay in ascending order.
+    # numpy's stable sort is a linear time radix sort for keys of 16 bits
+    # or less, which covers the usual hash sizes
+    sort_keys = keys
+    if len(keys) > 0 and keys.min() >= 0 and keys.max() < 2 ** 16:
+        sort_keys = keys.astype(np.uint16)
+    order = np.argsort(sort_keys, kind="stable")
 
-    return index2row
+    # buckets start where the sorted key changes, no need for np.unique to
+    # sort the keys a second time
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+    if len(sorted_keys) > 0:
+        starts = np.r_[0, starts]
+    unique_keys = sorted_keys[starts]
+    offsets = np.r_[starts, len(order)]
+
+    # NOTE: this is a import speed optimization
+    # allocating a new LongTensor per bucket is non trivial and will dominate
+    # the evaluation process time, so every bucket is a view of one tensor
+    sorted_rows = torch.from_numpy(rows[order])
+    if cuda:
+        sorted_rows = sorted_rows.cuda()
+    return unique_keys, offsets, sorted_rows
 
 
 class Indexer:
 
-    def __init__(self, hashing, candidate_vectors_gpu, distance_func):
+    def __init__(self, hashing, candidate_vectors_gpu, distance_func, norm_func=None):
+        """
+        distance_func: pairwise distance, (n, d), (m, d) -> (n, m).
+            If `norm_func` is given, it also takes the (m) candidate norms.
+        norm_func: per candidate term of `distance_func`, (m, d) -> (m),
+            computed once for all candidates instead of on every query
+        """
         self._hashing = hashing
         self._candidate_vectors_gpu = candidate_vectors_gpu
         self._distance_func = distance_func
 
+        self._candidate_norms = None
+        if norm_func is not None:
+            self._candidate_norms = norm_func(candidate_vectors_gpu)
+
         self._build_index()
 
     def _build_index(self):
         indexes = self.hash(self._candidate_vectors_gpu, hash_times=1)
-        self.index2row = build_index(indexes)
+        # keep bucket rows on the same device as the candidates, so the
+        # candidate selection in `query` never leaves the device
+        self._keys, self._offsets, self._rows = build_index(
+            indexes,
+            cuda=self._candidate_vectors_gpu.is_cuda,
+        )
+
+    @property
+    def n_buckets(self):
+        return len(self._keys)
 
-    def hash(self, query_vectors, batch_size=4096, hash_times=1):
-        hash_keys = []
+    @property
+    def bucket_sizes(self):
+        return np.diff(self._offsets)
 
+    def hash(self, query_vectors, batch_size=32768, hash_times=1):
         n = query_vectors.shape[0]
-        n_batches = n // batch_size
+        n_batches = (n + batch_size - 1) // batch_size
+
+        # NOTE: preallocate and fill by slice instead of growing the list
+        # batch by batch, large batches also keep the number of kernel
+        # launches of the hash forward pass small
+        hash_keys = [None] * n
         for idx in range(n_batches):
             start = idx * batch_size
-            end = (idx + 1) * batch_size
+            end = min((idx + 1) * batch_size, n)
             batch = query_vectors[start:end, :]
-            hash_key = self._hashing.hash(batch, hash_times)
-            hash_keys += hash_key
-        last_batch = query_vectors[n_batches*batch_size:, :]
-        hash_key = self._hashing.hash(last_batch)
-        hash_keys += hash_key
+            hash_keys[start:end] = self._hashing.hash(batch, hash_times)
         return hash_keys
 
-    def query(self, query_vectors, k=10, hash_times=10) -> List[List[int]]:
-        query_indexes = self.hash(query_vectors, hash_times=hash_times)
-        recall_result = []
-        n_candidates_result = []
-        vector_buffer = torch.empty_like(self._candidate_vectors_gpu).cuda()
-        default_empty_rows = torch.LongTensor([]).cuda()
-        for idx, qi in enumerate(query_indexes):
-            n_candidates = 0
-            target_vector = query_vectors[idx, :]
-            buffer_start = 0
-            candidate_rows_list = []
-            for key in list(qi):
-                candidate_rows = self.index2row.get(key, default_empty_rows)
-                candidate_rows_list.append(candidate_rows)
-                current_key_candidates = len(candidate_rows)
-                n_candidates += current_key_candidates
-                buffer_end = buffer_start + current_key_candidates
-
-                # NOTE: indexing with tensor will create a copy
-                # use index_select will directly move data from one to
-                # another. This highly reduce the memory allocation overhead
-                torch.index_select(
-                    self._candidate_vectors_gpu,
-                    0,
-                    candidate_rows,
-                    out=vector_buffer[buffer_start:buffer_end, :],
+    def _bucket_topk(self, queries, candidate_rows, k):
+        """topk nearest candidates of every query among `candidate_rows`
+
+        queries: (n, d)
+        candidate_rows: (m)
+
+        Returns
+        distances: (n, min(k, m)), rows: (n, min(k, m))
+        """
+        # NOTE: candidates are streamed in chunks and merged into a running
+        # topk, so a huge bucket (e.g. an untrained hash putting everything
+        # in one bucket) never materializes the full distance matrix
+        chunk_size = max(k, MAX_DISTANCE_ELEMENTS // queries.shape[0])
+        best_distances, best_rows = None, None
+        for start in range(0, len(candidate_rows), chunk_size):
+            rows = candidate_rows[start:start + chunk_size]
+            # NOTE: the candidates are gathered per chunk rather than into a
+            # preallocated buffer of the whole candidate set, buckets are
+            # small so the allocation is cheap compared to an (N, d) buffer
+            candidates = self._candidate_vectors_gpu.index_select(0, rows)
+            if self._candidate_norms is None:
+                distances = self._distance_func(queries, candidates)
+            else:
+                distances = self._distance_func(
+                    queries,
+                    candidates,
+                    self._candidate_norms.index_select(0, rows),
+                )
+            distances, topk_idxs = distances.topk(min(k, len(rows)), dim=1, largest=False)
+            rows = rows[topk_idxs]
+            if best_distances is not None:
+                distances = torch.cat((best_distances, distances), dim=1)
+                rows = torch.cat((best_rows, rows), dim=1)
+                distances, topk_idxs = distances.topk(
+                    min(k, distances.shape[1]),
+                    dim=1,
+                    largest=False,
                 )
-                buffer_start = buffer_end
-            distance = self._distance_func(
-                target_vector,
-                vector_buffer[:buffer_end, :],
+                rows = rows.gather(1, topk_idxs)
+            best_distances, best_rows = distances, rows
+        return best_distances, best_rows
+
+    def query(self, query_vectors, k=10, hash_times=10) -> Tuple[np.ndarray, List[int]]:
+        """
+        Returns
+        topk_rows: (n, k) rows of the nearest candidates of each query, queries
+            with less than k candidates are padded with -1 at the end. Rows
+            are sorted by distance only for queries with more than k
+            candidates, otherwise their order is unspecified
+        n_candidates: number of candidates of each query
+        """
+        device = self._candidate_vectors_gpu.device
+        query_vectors = query_vectors.to(device, non_blocking=True)
+        query_indexes = self.hash(query_vectors, hash_times=hash_times)
+        n_queries = len(query_indexes)
+        n_slots = max((len(qi) for qi in query_indexes), default=1)
+
+        # look up the buckets of all probes at once, `slot` records which of
+        # the query's probes the bucket came from
+        probe_keys, probe_queries, probe_slots = _flatten(query_indexes)
+        buckets = np.searchsorted(self._keys, probe_keys)
+        hit = buckets < len(self._keys)
+        hit[hit] = self._keys[buckets[hit]] == probe_keys[hit]
+        buckets, probe_queries, probe_slots = buckets[hit], probe_queries[hit], probe_slots[hit]
+
+        n_candidates = np.bincount(
+            probe_queries,
+            weights=self.bucket_sizes[buckets],
+            minlength=n_queries,
+        ).astype(np.int64)
+
+        # per (query, probe) topk, merged into the final topk afterwards
+        topk_distances = torch.full((n_queries, n_slots, k), float("inf"), device=device)
+        topk_rows = torch.full((n_queries, n_slots, k), -1, dtype=torch.long, device=device)
+
+        # NOTE: queries with at most k candidates keep all of them, so their
+        # distances are never computed and buckets only probed by such
+        # queries launch no kernels at all
+        small = n_candidates[probe_queries] <= k
+        if small.any():
+            sizes = self.bucket_sizes[buckets[small]]
+            positions = _ranges(sizes)
+            candidate_idxs = np.repeat(self._offsets[buckets[small]], sizes) + positions
+            candidate_idxs = _to_device(candidate_idxs, device)
+            fill_queries = _to_device(np.repeat(probe_queries[small], sizes), device)
+            fill_slots = _to_device(np.repeat(probe_slots[small], sizes), device)
+            positions = _to_device(positions, device)
+            topk_distances[fill_queries, fill_slots, positions] = 0
+            topk_rows[fill_queries, fill_slots, positions] = self._rows[candidate_idxs]
+        buckets = buckets[~small]
+        probe_queries = probe_queries[~small]
+        probe_slots = probe_slots[~small]
+
+        # NOTE: group queries by the buckets they probe, so every bucket costs
+        # one batched distance computation + topk instead of one per query.
+        order = np.argsort(buckets, kind="stable")
+        buckets = buckets[order]
+        probe_queries = _to_device(probe_queries[order], device)
+        probe_slots = _to_device(probe_slots[order], device)
+        unique_buckets, group_starts = np.unique(buckets, return_index=True)
+        group_ends = np.r_[group_starts[1:], len(buckets)]
+
+        for bucket, start, end in zip(unique_buckets, group_starts, group_ends):
+            candidate_rows = self._rows[self._offsets[bucket]:self._offsets[bucket + 1]]
+            query_rows = probe_queries[start:end]
+            slots = probe_slots[start:end]
+
+            bucket_distances, bucket_rows = self._bucket_topk(
+                query_vectors.index_select(0, query_rows),
+                candidate_rows,
+                k,
             )
-            concat_candidate_rows = torch.cat(candidate_rows_list)
-            try:
-                topk_idxs = distance.topk(k, largest=False)[1]
-                topk_idxs = concat_candidate_rows[topk_idxs].tolist()
-            except RuntimeError:
-                topk_idxs = candidate_rows.tolist()
-            n_candidates_result.append(n_candidates)
-            recall_result.append(topk_idxs)
-        return recall_result, n_candidates_result
+            bucket_k = bucket_distances.shape[1]
+            topk_distances[query_rows, slots, :bucket_k] = bucket_distances
+            topk_rows[query_rows, slots, :bucket_k] = bucket_rows
+
+        topk_idxs = topk_distances.view(n_queries, n_slots * k).topk(k, dim=1, largest=False)[1]
+        topk_rows = topk_rows.view(n_queries, n_slots * k).gather(1, topk_idxs)
+        return topk_rows.cpu().numpy(), n_candidates.tolist()
@@ -1,10 +1,18 @@
 from typing import List, Union
 
+import numpy as np
 
-def _recall(y_true: List[int], y_pred: List[int]) -> float:
-    n_true = len(y_true)
-    true_positives = len(set(y_true) & set(y_pred))
-    return true_positives / n_true
+
+def _to_padded_array(rows, fill_value=-1) -> np.ndarray:
+    # NOTE: `Indexer.query` already returns a padded array, lists are only
+    # padded here for other callers
+    if isinstance(rows, np.ndarray):
+        return rows
+    width = max((len(row) for row in rows), default=0)
+    padded = np.full((len(rows), width), fill_value, dtype=np.int64)
+    for idx, row in enumerate(rows):
+        padded[idx, :len(row)] = row
+    return padded
 
 
 def calculate_recall(
@@ -12,13 +20,14 @@ def calculate_recall(
         y_pred: List[List[int]],
         reduce_func=None,
     ) -> Union[List[float], float]:
-    # TODO: unittest
-
     assert len(y_true) == len(y_pred)
-    recalls = [
-        _recall(yt, yp)
-        for yt, yp in zip(y_true, y_pred)
-    ]
+
+    # NOTE: compare all queries at once instead of building two python sets
+    # per query, predictions may be shorter than k so they are padded with -1
+    y_true = _to_padded_array(y_true)
+    y_pred = _to_padded_array(y_pred)
+    true_positives = (y_true[:, :, None] == y_pred[:, None, :]).any(axis=2).sum(axis=1)
+    recalls = (true_positives / y_true.shape[1]).tolist()
 
     if reduce_func is not None:
         return reduce_func(recalls)
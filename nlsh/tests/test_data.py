@@ -0,0 +1,22 @@
+import torch
+import torch.nn.functional as F
+
+from ..data import Glove, SIFT
+
+
+def test_glove_pairwise_distance():
+    v1 = torch.randn(5, 7)
+    v2 = torch.randn(9, 7)
+    expected = 1 - F.cosine_similarity(v1[:, None, :], v2[None, :, :], dim=-1)
+
+    assert torch.allclose(Glove.pairwise_distance(v1, v2), expected, atol=1e-5)
+    assert torch.allclose(Glove.pairwise_distance(v1, v2, Glove.norm(v2)), expected, atol=1e-5)
+
+
+def test_sift_pairwise_distance():
+    v1 = torch.randint(0, 256, (5, 128)).float()
+    v2 = torch.randint(0, 256, (9, 128)).float()
+    expected = torch.cdist(v1, v2)
+
+    assert torch.allclose(SIFT.pairwise_distance(v1, v2), expected, rtol=1e-4)
+    assert torch.allclose(SIFT.pairwise_distance(v1, v2, SIFT.norm(v2)), expected, rtol=1e-4)
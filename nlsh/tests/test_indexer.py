@@ -1,6 +1,8 @@
+import numpy as np
 import torch
 
-from ..indexer import build_index
+from .. import indexer as indexer_module
+from ..indexer import Indexer, build_index
 
 
 def test_build_index():
@@ -9,7 +11,7 @@ def test_build_index():
         set([2, 3, 4]),
         set([1, 5]),
     ]
-    index2row = build_index(indexes, cuda=False)
+    keys, offsets, rows = build_index(indexes, cuda=False)
     expected = {
         1: torch.LongTensor([0, 2]),
         2: torch.LongTensor([0, 1]),
@@ -17,10 +19,108 @@ def test_build_index():
         4: torch.LongTensor([1]),
         5: torch.LongTensor([2]),
     }
-    assert index2row.keys() == expected.keys()
+    np.testing.assert_array_equal(keys, np.array(sorted(expected.keys())))
+    assert offsets.shape == (len(keys) + 1,)
 
-    for k in index2row.keys():
+    for idx, k in enumerate(keys):
         expected_idxs = expected[k]
-        actual_idxs = index2row[k]
+        actual_idxs = rows[offsets[idx]:offsets[idx + 1]]
 
         assert torch.equal(expected_idxs, actual_idxs)
+
+
+class _SignHashing:
+
+    def hash(self, query_vectors, n=1):
+        return [set([int(x > 0)]) for x in query_vectors[:, 0].tolist()]
+
+
+def test_indexer_query():
+    candidates = torch.tensor([
+        [1., 0.],
+        [2., 1.],
+        [3., 3.],
+        [-1., 0.],
+        [-2., -1.],
+    ])
+    indexer = Indexer(
+        _SignHashing(),
+        candidates,
+        lambda v1, v2: torch.cdist(v1, v2),
+    )
+    assert indexer.n_buckets == 2
+    np.testing.assert_array_equal(indexer.bucket_sizes, np.array([2, 3]))
+
+    queries = torch.tensor([
+        [2.5, 2.5],
+        [-1.2, -0.2],
+        [1.1, 0.],
+    ])
+    result, n_candidates = indexer.query(queries, k=2, hash_times=1)
+    # queries with at most k candidates skip ranking, their order is not defined
+    assert [sorted(rows) for rows in result.tolist()] == [[1, 2], [3, 4], [0, 1]]
+    assert n_candidates == [3, 2, 3]
+
+    result, n_candidates = indexer.query(queries[:0], k=2, hash_times=1)
+    assert result.shape == (0, 2)
+    assert n_candidates == []
+
+
+class _TableHashing:
+    """hash by the first coordinate, probes of codes >= 10 are looked up in a table"""
+
+    table = {
+        10: set([0, 1]),
+        11: set([1]),
+        12: set([5]),
+        13: set([1, 2]),
+    }
+
+    def hash(self, query_vectors, n=1):
+        codes = [int(x) for x in query_vectors[:, 0].tolist()]
+        return [self.table.get(code, set([code])) for code in codes]
+
+
+def test_indexer_query_few_candidates():
+    candidates = torch.tensor([
+        [0., 7.],
+        [0., 8.],
+        [1., 0.],
+        [2., 1.],
+        [2., 2.],
+        [2., 3.],
+        [2., 4.],
+        [2., 5.],
+    ])
+    indexer = Indexer(
+        _TableHashing(),
+        candidates,
+        lambda v1, v2: torch.cdist(v1[:, 1:], v2[:, 1:]),
+    )
+    queries = torch.tensor([
+        [10., 0.],  # 3 candidates from 2 probes
+        [11., 0.],  # 1 candidate
+        [12., 0.],  # probes an empty bucket
+        [13., 0.],  # 6 candidates from 2 probes, ranked
+    ])
+    result, n_candidates = indexer.query(queries, k=4, hash_times=2)
+    assert n_candidates == [3, 1, 0, 6]
+    assert [sorted(rows) for rows in result.tolist()] == [
+        [-1, 0, 1, 2],
+        [-1, -1, -1, 2],
+        [-1, -1, -1, -1],
+        [2, 3, 4, 5],
+    ]
+
+
+def test_indexer_query_chunked(monkeypatch):
+    candidates = torch.randn(100, 4)
+    queries = torch.randn(8, 4)
+    distance_func = lambda v1, v2: torch.cdist(v1, v2)  # noqa: E731
+    indexer = Indexer(_SignHashing(), candidates, distance_func)
+    expected, expected_n_candidates = indexer.query(queries, k=5, hash_times=1)
+
+    monkeypatch.setattr(indexer_module, "MAX_DISTANCE_ELEMENTS", 8 * 7)
+    result, n_candidates = indexer.query(queries, k=5, hash_times=1)
+    np.testing.assert_array_equal(result, expected)
+    assert n_candidates == expected_n_candidates
@@ -0,0 +1,21 @@
+import numpy as np
+
+from ..metrics import calculate_recall
+
+
+def test_calculate_recall():
+    y_true = np.array([
+        [1, 2, 3],
+        [4, 5, 6],
+        [7, 8, 9],
+    ])
+    y_pred = [
+        [3, 1, 2],
+        [4, 0],
+        [],
+    ]
+    recalls = calculate_recall(y_true, y_pred)
+    np.testing.assert_array_almost_equal(recalls, [1., 1 / 3, 0.])
+
+    recall = calculate_recall(list(y_true), y_pred, np.mean)
+    np.testing.assert_almost_equal(recall, 4 / 9)
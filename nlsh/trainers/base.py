@@ -1,4 +1,6 @@
 import abc
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
 import torch
@@ -7,6 +9,9 @@ import numpy as np
 from nlsh.metrics import calculate_recall
 from nlsh.indexer import Indexer
 
+# training losses are copied to host and logged once every this many steps
+LOSS_LOG_INTERVAL = 100
+
 
 class Trainer(abc.ABC):
 
@@ -33,25 +38,89 @@ class Trainer(abc.ABC):
     def _get_extra_models_parameters(self):
         return []
 
-    def fit(self, K, batch_size=1024, learning_rate=3e-4, test_every_updates=1000):
+    def _upload_data(self, K):
         if not self._data.prepared:
             self._data.load()
         candidate_vectors = self._data.training
-        validation_data = self._data.testing
         candidate_self_knn = self._data.training_self_knn
-        ground_truth = self._data.ground_truth[:, :K]
+        self._ground_truth = self._data.ground_truth[:, :K]
 
-        self._candidate_vectors_gpu = torch.from_numpy(candidate_vectors).cuda()
-        self._validation_data = torch.from_numpy(validation_data)
-        self._validation_data_gpu = self._validation_data.cuda()
+        # NOTE: uploads from pinned memory are faster than from pageable
+        # memory and asynchronous, so they don't block the following kernels
+        self._candidate_vectors_gpu = (
+            torch.from_numpy(candidate_vectors).pin_memory().cuda(non_blocking=True)
+        )
+        self._candidate_self_knn_gpu = (
+            torch.from_numpy(candidate_self_knn).pin_memory().cuda(non_blocking=True)
+        )
+        self._validation_data = torch.from_numpy(self._data.testing).pin_memory()
+        self._validation_data_gpu = self._validation_data.cuda(non_blocking=True)
 
         sampled_index = np.random.randint(candidate_vectors.shape[0], size=(10000,))
-        sampled_train = self._candidate_vectors_gpu[sampled_index, :]
-        sampled_train_ground_truth = candidate_self_knn[sampled_index, :K]
+        self._sampled_train = self._candidate_vectors_gpu[sampled_index, :]
+        self._sampled_train_ground_truth = candidate_self_knn[sampled_index, :K]
+
+    def _log_losses(self, losses, last_step):
+        """log the losses of the steps ending at `last_step` with one copy to host"""
+        if not losses:
+            return
+        first_step = last_step - len(losses) + 1
+        for step, value in enumerate(torch.stack(losses).tolist(), first_step):
+            self._logger.log("training/loss", value, step)
+
+    def _save_in_background(self, base_name):
+        # NOTE: scripting and writing the model takes a while,
+        # save a snapshot in the background so training goes on.
+        # Wait for the previous save to surface its errors.
+        if self._save_future is not None:
+            self._save_future.result()
+        snapshot = copy.deepcopy(self._hashing)
+        self._save_future = self._save_pool.submit(snapshot.save, base_name)
+
+    def _evaluate(self, K, global_step):
+        self._hashing.train_mode(False)
+        indexer = Indexer(
+            self._hashing,
+            self._candidate_vectors_gpu,
+            self._data.pairwise_distance,
+            norm_func=self._data.norm,
+        )
+        n_indexes = indexer.n_buckets
+        self._logger.log("test/n_indexes", n_indexes, global_step)
+        std_index_rows = np.std(indexer.bucket_sizes)
+        self._logger.log("test/std_index_rows", std_index_rows, global_step)
+
+        # Validation
+        t1 = time()
+        recalls, n_candidates = indexer.query(self._validation_data_gpu, k=K)
+        t2 = time()
+        query_time = t2 - t1
+        current_recall = calculate_recall(self._ground_truth, recalls, np.mean)
+        current_query_size = np.mean(n_candidates)
+
+        if (current_recall > self._best_recall) and (current_query_size < self._best_query_size):
+            base_name = f"{self._model_save_dir}/{self._logger.run_name}_{global_step}_{current_recall:.4f}"
+            self._save_in_background(base_name)
+            self._best_recall = current_recall
+
+        self._logger.log("test/recall", current_recall, global_step)
+        self._logger.log("test/query_size", current_query_size, global_step)
+        qps = self._validation_data.shape[0] / query_time
+        self._logger.log("test/qps", qps, global_step)
+
+        # Evaluate training set (see if overfit)
+        recalls, n_candidates = indexer.query(self._sampled_train, k=K)
+        train_recall = calculate_recall(self._sampled_train_ground_truth, recalls, np.mean)
+        train_query_size = np.mean(n_candidates)
+        self._logger.log("training/recall", train_recall, global_step)
+        self._logger.log("training/query_size", train_query_size, global_step)
+
+    def fit(self, K, batch_size=1024, learning_rate=3e-4, test_every_updates=1000):
+        self._upload_data(K)
 
         dataset = self._get_dataset(
             self._candidate_vectors_gpu,
-            torch.from_numpy(candidate_self_knn).cuda(),
+            self._candidate_self_knn_gpu,
         )
         self._prepare_extra_models()
 
@@ -62,8 +131,11 @@ class Trainer(abc.ABC):
         )
 
         global_step = 0
-        best_recall = 0.
-        best_query_size = float("Inf")
+        self._best_recall = 0.
+        self._best_query_size = float("Inf")
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+        loss_buffer = []
 
         for _ in range(100):
             for sampled_batch in dataset.batch_generator(batch_size, True):
@@ -74,42 +146,23 @@ class Trainer(abc.ABC):
 
                 loss = self._get_loss(sampled_batch)
 
-                self._logger.log("training/loss", loss.data.cpu(), global_step)
                 loss.backward()
                 optimizer.step()
+
+                # NOTE: copying the loss to host every step forces a device
+                # sync per step, keep them on device and copy them at once
+                loss_buffer.append(loss.detach())
+                if global_step % LOSS_LOG_INTERVAL == 0:
+                    self._log_losses(loss_buffer, global_step)
+                    loss_buffer = []
+
                 if global_step % test_every_updates == 0:
-                    self._hashing.train_mode(False)
-                    indexer = Indexer(
-                        self._hashing,
-                        self._candidate_vectors_gpu,
-                        self._data.distance,
-                    )
-                    n_indexes = len(indexer.index2row)
-                    self._logger.log("test/n_indexes", n_indexes, global_step)
-                    std_index_rows = np.std([len(idxs) for idxs in indexer.index2row.values()])
-                    self._logger.log("test/std_index_rows", std_index_rows, global_step)
-
-                    # Validation
-                    t1 = time()
-                    recalls, n_candidates = indexer.query(self._validation_data_gpu, k=K)
-                    t2 = time()
-                    query_time = t2 - t1
-                    current_recall = calculate_recall(list(ground_truth), recalls, np.mean)
-                    current_query_size = np.mean(n_candidates)
-
-                    if (current_recall > best_recall) and (current_query_size < best_query_size):
-                        base_name = f"{self._model_save_dir}/{self._logger.run_name}_{global_step}_{current_recall:.4f}"
-                        self._hashing.save(base_name)
-                        best_recall = current_recall
-
-                    self._logger.log("test/recall", current_recall, global_step)
-                    self._logger.log("test/query_size", current_query_size, global_step)
-                    qps = self._validation_data.shape[0] / query_time
-                    self._logger.log("test/qps", qps, global_step)
-
-                    # Evaluate training set (see if overfit)
-                    recalls, n_candidates = indexer.query(sampled_train, k=K)
-                    train_recall = calculate_recall(list(sampled_train_ground_truth), recalls, np.mean)
-                    train_query_size = np.mean(n_candidates)
-                    self._logger.log("training/recall", train_recall, global_step)
-                    self._logger.log("training/query_size", train_query_size, global_step)
+                    # NOTE: no autograd graph (and saved tensors) for the
+                    # hashing forward passes of the evaluation
+                    with torch.no_grad():
+                        self._evaluate(K, global_step)
+
+        self._log_losses(loss_buffer, global_step)
+        if self._save_future is not None:
+            self._save_future.result()
+        self._save_pool.shutdown()
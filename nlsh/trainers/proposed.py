@@ -77,7 +77,7 @@ class ProposedTrainer(Trainer):
         """
         dataset = KNearestNeighborAllOut(
             vectors,
-            torch.tensor(self_knn, dtype=torch.long).cuda(),
+            self_knn.long(),
             k=self._train_k,
         )
         return dataset
@@ -88,9 +88,6 @@ class ProposedTrainer(Trainer):
         hashed_positives = self._hashing.predict(
             batch[1].view(-1, batch[0].shape[-1])
         ).view(batch_size, -1, hashed_anchor.shape[-1])
-        n = self._candidate_vectors_gpu.shape[0]
-        sampled_candidate_vectors = self._candidate_vectors_gpu[np.random.randint(0, n, (65536,)), :]
-        hashed_candidates = self._hashing.predict(sampled_candidate_vectors)
 
         # knns should have smaller code distance
         positive_loss = self._hashing._distance_func.row_pairwise(
@@ -98,6 +95,15 @@ class ProposedTrainer(Trainer):
             hashed_positives,
         ).sum(dim=1).mean()
 
+        # NOTE: the query size term hashes 65536 sampled candidates every
+        # step, skip it entirely when it doesn't contribute to the loss
+        if self._lambda1 == 0:
+            return positive_loss
+
+        n = self._candidate_vectors_gpu.shape[0]
+        sampled_candidate_vectors = self._candidate_vectors_gpu[np.random.randint(0, n, (65536,)), :]
+        hashed_candidates = self._hashing.predict(sampled_candidate_vectors)
+
         query_index = self._hashing.hash(batch[0], n=1)
         query_index = [list(qi)[0] for qi in query_index]
         candidate_index = self._hashing.hash(sampled_candidate_vectors, n=1)